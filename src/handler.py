@@ -1,230 +1,908 @@
 import runpod
 import os
-import json
+import time
+import random
+import socket
+import threading
+import sys
+import orjson
 import requests
-import tempfile
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 import websocket
 import uuid
-import traceback
-import urllib.parse
-import base64
+import pybase64
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+from dataclasses import dataclass
+from typing import NamedTuple
 from io import BytesIO
 import pathlib
 
+logger = logging.getLogger("worker-comfyui")
+
 # -----------------------------------------------------------------------------
 # ENVIRONMENT
 # -----------------------------------------------------------------------------
-CF_IMAGES_ACCOUNT_ID = os.environ.get("CF_IMAGES_ACCOUNT_ID")
-CF_IMAGES_API_TOKEN = os.environ.get("CF_IMAGES_API_TOKEN")
 COMFY_HOST = os.environ.get("COMFYUI_HOST", "127.0.0.1")
 COMFY_PORT = os.environ.get("COMFYUI_PORT", "8080")
-COMFY_URL = f"http://{COMFY_HOST}:{COMFY_PORT}"
+# Optional path to a Unix domain socket that serves the ComfyUI HTTP API (e.g.
+# a local proxy in front of ComfyUI). When set, HTTP calls skip the TCP stack;
+# the websocket still connects over TCP.
+COMFY_UDS = os.environ.get("COMFY_UDS")
+if COMFY_UDS:
+    COMFY_URL = "http+unix://" + COMFY_UDS.replace("/", "%2F")
+else:
+    COMFY_URL = f"http://{COMFY_HOST}:{COMFY_PORT}"
 WS_URL = f"ws://{COMFY_HOST}:{COMFY_PORT}/ws?clientId="
+QUEUE_URL = f"{COMFY_URL}/queue"
+INTERRUPT_URL = f"{COMFY_URL}/interrupt"
+PROMPT_URL = f"{COMFY_URL}/prompt"
+HISTORY_URL = f"{COMFY_URL}/history/"
+VIEW_URL = f"{COMFY_URL}/view"
+OBJECT_INFO_URL = f"{COMFY_URL}/object_info"
+JSON_HEADERS = {"Content-Type": "application/json"}
+WORKFLOWS_DIR = pathlib.Path(os.environ.get("WORKFLOWS_DIR", "/workspace/worker/workflows"))
+
+
+@dataclass(frozen=True)
+class Config:
+    cf_images_account_id: str | None
+    cf_images_api_token: str | None
+    # Derived once from the two above; None unless both are set
+    cf_images_url: str | None
+    cf_images_authorization: str | None
+    # Longest silence (seconds) tolerated on the websocket while a prompt runs.
+    # ComfyUI sends progress frames throughout sampling, so this only trips
+    # when the server is stuck.
+    ws_recv_timeout: float
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("⚠️ Ignoring invalid %s=%r, using %s", name, value, default)
+        return default
+
+
+@functools.lru_cache(maxsize=1)
+def get_config():
+    """
+    Read the environment-driven settings once and reuse them.
+    Call get_config.cache_clear() to pick up a changed environment (e.g. in tests).
+    """
+    account_id = os.environ.get("CF_IMAGES_ACCOUNT_ID")
+    api_token = os.environ.get("CF_IMAGES_API_TOKEN")
+    configured = bool(account_id and api_token)
+    return Config(
+        cf_images_account_id=account_id,
+        cf_images_api_token=api_token,
+        cf_images_url=(
+            f"https://api.cloudflare.com/client/v4/accounts/{account_id}/images/v1"
+            if configured else None
+        ),
+        cf_images_authorization=f"Bearer {api_token}" if configured else None,
+        ws_recv_timeout=_env_float("COMFY_WS_TIMEOUT", 300.0),
+    )
+
+# -----------------------------------------------------------------------------
+# HTTP SESSION
+# -----------------------------------------------------------------------------
+# One pooled session for ComfyUI and Cloudflare so keep-alive connections (and
+# TLS sessions for Cloudflare) are reused across calls and across warm jobs.
+# Idempotent GETs are retried on transient 502/503/504s and dropped reads.
+# Refused connects are not retried because check_comfy_ready does its own
+# polling. POSTs are never retried: that could queue a prompt twice.
+# Readiness probes go through PROBE_SESSION, which never retries, so their
+# timeout really bounds each probe and a read timeout surfaces as Timeout.
+_RETRY = Retry(
+    total=3,
+    connect=0,
+    backoff_factor=0.2,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset({"GET"}),
+    raise_on_status=False,
+)
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=_RETRY)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+if COMFY_UDS:
+    import requests_unixsocket
+
+    # Same retry policy for ComfyUI over the Unix socket. UnixAdapter keeps one
+    # small pool per URL, so pool_connections bounds how many it keeps open.
+    SESSION.mount("http+unix://", requests_unixsocket.UnixAdapter(pool_connections=32, max_retries=_RETRY))
+SESSION.headers["Connection"] = "keep-alive"
+
+PROBE_SESSION = requests.Session()
+PROBE_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+if COMFY_UDS:
+    PROBE_SESSION.mount("http+unix://", requests_unixsocket.UnixAdapter(pool_connections=1, max_retries=0))
 
 # -----------------------------------------------------------------------------
 # HELPERS
 # -----------------------------------------------------------------------------
 
-def upload_to_cloudflare_images(file_path):
-    if not CF_IMAGES_ACCOUNT_ID or not CF_IMAGES_API_TOKEN:
-        print("⚠️ No Cloudflare Images credentials configured.")
+def upload_to_cloudflare_images(image_bytes, filename):
+    config = get_config()
+    if not config.cf_images_url:
+        logger.warning("⚠️ No Cloudflare Images credentials configured.")
         return None
 
-    url = f"https://api.cloudflare.com/client/v4/accounts/{CF_IMAGES_ACCOUNT_ID}/images/v1"
-    headers = {"Authorization": f"Bearer {CF_IMAGES_API_TOKEN}"}
-    with pathlib.Path(file_path).open("rb") as img:
-        files = {"file": img}
-        data = {"requireSignedURLs": "false"}
-        try:
-            response = requests.post(url, headers=headers, files=files, data=data)
-            response.raise_for_status()
-            data = response.json()
-            if data.get("success"):
-                return data["result"]["variants"][0]
-            else:
-                print(f"Cloudflare upload error: {data.get('errors')}")
-        except Exception as e:
-            print(f"Cloudflare upload exception: {e}")
+    # MultipartEncoder streams the parts to the socket instead of building a
+    # second copy of the image inside the multipart body
+    encoder = MultipartEncoder(fields={
+        "file": (filename, BytesIO(image_bytes), "image/png"),
+        "requireSignedURLs": "false",
+    })
+    headers = {
+        "Authorization": config.cf_images_authorization,
+        "Content-Type": encoder.content_type,
+    }
+    try:
+        response = SESSION.post(config.cf_images_url, headers=headers, data=encoder, timeout=60)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        if data.get("success"):
+            return data["result"]["variants"][0]
+        else:
+            logger.error("Cloudflare upload error: %s", data.get("errors"))
+    except Exception as e:
+        logger.error("Cloudflare upload exception: %s", e)
     return None
 
 def check_comfy_ready(timeout=120):
-    import time
-    start = time.time()
-    while time.time() - start < timeout:
+    """
+    Poll ComfyUI until it answers on /queue. The first probes are only a few
+    milliseconds apart so an already-running server is picked up right away;
+    the delay then backs off to at most 250 ms until the deadline.
+
+    On warm jobs, while the worker's websocket is open, a single short probe
+    re-verifies the server. If it fails (e.g. ComfyUI crashed between jobs),
+    the stale websocket is dropped and the full polling runs again.
+    """
+    if _ws is not None and _ws.connected:
+        try:
+            if PROBE_SESSION.get(QUEUE_URL, timeout=0.5).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        reset_ws()
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while time.monotonic() < deadline:
         try:
-            r = requests.get(f"{COMFY_URL}/queue", timeout=5)
+            r = PROBE_SESSION.get(QUEUE_URL, timeout=2)
             if r.status_code == 200:
                 return True
-        except Exception:
+        except requests.Timeout:
+            # The probe itself already waited, retry straight away
+            continue
+        except requests.RequestException:
             pass
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.7, 0.25)
     return False
 
-def connect_ws(client_id):
-    ws = websocket.WebSocket()
-    ws.connect(WS_URL + client_id)
-    return ws
+# websocket-client already sets TCP_NODELAY by default; a 1 MiB receive buffer
+# lets large binary preview frames arrive with fewer wake-ups
+WS_SOCKOPT = ((socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20),)
+
+def connect_ws(client_id, max_attempts=5):
+    """
+    Open the ComfyUI websocket. Failed attempts are retried right away once and
+    then with exponential backoff plus jitter (200 ms doubling, capped at 3 s).
+    """
+    last_error = None
+    for attempt in range(max_attempts):
+        if attempt > 1:
+            delay = min(0.2 * (2 ** (attempt - 2)) + random.uniform(0, 0.1), 3.0)
+            time.sleep(delay)
+        try:
+            # Cheap TCP probe first so a refused port fails in well under a
+            # second instead of going through a full websocket handshake
+            socket.create_connection((COMFY_HOST, int(COMFY_PORT)), timeout=0.5).close()
+            ws = websocket.WebSocket(sockopt=WS_SOCKOPT)
+            ws.connect(WS_URL + client_id)
+            ws.settimeout(get_config().ws_recv_timeout)
+            return ws
+        except (websocket.WebSocketException, OSError) as e:
+            last_error = e
+            logger.warning("Websocket connect attempt %d/%d failed: %s", attempt + 1, max_attempts, e)
+    raise last_error
+
+# One websocket per worker process, reused across warm jobs. ComfyUI routes
+# progress messages by client id, so the id lives as long as the connection.
+CLIENT_ID = str(uuid.uuid4())
+_ws = None
+# Guards _ws: the startup warm-up thread and the first job may both connect,
+# and a second connection with the same client id would steal its messages
+_ws_lock = threading.Lock()
+
+def get_ws():
+    """Return the worker's ComfyUI websocket, (re)connecting if needed."""
+    global _ws
+    with _ws_lock:
+        if _ws is None or not _ws.connected:
+            _ws = connect_ws(CLIENT_ID)
+        return _ws
+
+def reset_ws():
+    """Drop the worker's websocket so the next get_ws() reconnects."""
+    global _ws
+    with _ws_lock:
+        if _ws is not None:
+            try:
+                _ws.close()
+            except Exception:
+                pass
+        _ws = None
+
+def wait_for_prompt(prompt_id):
+    """
+    Block until ComfyUI reports that prompt_id finished executing. Messages
+    for other prompts (e.g. leftovers from an earlier job on the shared
+    websocket) are ignored. If the connection drops, reconnect once and check
+    /history in case the prompt finished while we were disconnected. Each
+    connection gives up after COMFY_WS_TIMEOUT seconds without a frame.
+
+    Returns the node outputs seen in "executed" messages ({node_id: output}),
+    or None if the connection dropped and they may be incomplete. Raises
+    RuntimeError with ComfyUI's message if the prompt failed.
+    """
+    observed_outputs = {}
+    for attempt in range(2):
+        ws = get_ws()
+        try:
+            while True:
+                # Raw frame bytes: binary preview images are skipped and text
+                # frames go to orjson without being decoded to str first
+                opcode, message = ws.recv_data()
+                if opcode != websocket.ABNF.OPCODE_TEXT:
+                    continue
+                # Most frames are status/progress ticks; peek at the "type"
+                # field and only parse the frames we act on
+                head = message[:32]
+                if (
+                    b'"executing"' not in head
+                    and b'"executed"' not in head
+                    and b'"execution_error"' not in head
+                ):
+                    continue
+                msg = orjson.loads(message)
+                data = msg.get("data", {})
+                if data.get("prompt_id") != prompt_id:
+                    continue
+                if msg.get("type") == "executed":
+                    observed_outputs[data["node"]] = data.get("output") or {}
+                elif msg.get("type") == "execution_error":
+                    raise RuntimeError(format_execution_error(data))
+                elif msg.get("type") == "executing" and data.get("node") is None:
+                    logger.info("Execution complete.")
+                    return observed_outputs
+        except (websocket.WebSocketException, OSError) as e:
+            reset_ws()
+            if attempt:
+                raise
+            logger.warning("Websocket dropped or timed out (%s), reconnecting...", e)
+            get_ws()
+            if get_history(prompt_id):
+                return None
+    return None
+
+def format_execution_error(data):
+    """Turn the data of an "execution_error" websocket message into one readable message."""
+    return (
+        f"ComfyUI failed at node {data.get('node_id')} ({data.get('node_type')}): "
+        f"{data.get('exception_type', 'Error')}: {data.get('exception_message', '').strip()}"
+    )
+
+def format_prompt_error(response):
+    """
+    Turn ComfyUI's 400 body ({"error": {...}, "node_errors": {...}}) into one
+    readable message. Falls back to the raw body if it is not JSON.
+    """
+    try:
+        body = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return f"ComfyUI rejected the workflow: {response.text}"
+
+    error = body.get("error")
+    if isinstance(error, dict):
+        error = error.get("message")
+    details = [
+        f"Node {node_id} ({node_error.get('class_type', 'unknown')}): "
+        f"{e.get('message', '')} {e.get('details', '')}".rstrip()
+        for node_id, node_error in body.get("node_errors", {}).items()
+        for e in node_error.get("errors", [])
+    ]
+    message = f"ComfyUI rejected the workflow: {error or 'validation failed'}"
+    if details:
+        message += "\n" + "\n".join(f"• {d}" for d in details)
+    return message
 
 def queue_prompt(prompt, client_id):
-    payload = json.dumps({"prompt": prompt, "client_id": client_id}).encode("utf-8")
-    r = requests.post(f"{COMFY_URL}/prompt", data=payload)
+    payload = orjson.dumps({"prompt": prompt, "client_id": client_id})
+    r = SESSION.post(PROMPT_URL, data=payload, headers=JSON_HEADERS, timeout=30)
+    if r.status_code == 400:
+        raise ValueError(format_prompt_error(r))
     r.raise_for_status()
-    return r.json()["prompt_id"]
+    return orjson.loads(r.content)["prompt_id"]
+
+def cancel_prompt(prompt_id):
+    """
+    Remove prompt_id from ComfyUI's queue, or interrupt it if it is already
+    running, so a job that gave up does not leave work that later jobs would
+    queue behind.
+    """
+    try:
+        SESSION.post(QUEUE_URL, data=orjson.dumps({"delete": [prompt_id]}), headers=JSON_HEADERS, timeout=5)
+        SESSION.post(INTERRUPT_URL, data=orjson.dumps({"prompt_id": prompt_id}), headers=JSON_HEADERS, timeout=5)
+    except requests.RequestException as e:
+        logger.warning("⚠️ Could not cancel prompt %s: %s", prompt_id, e)
 
 def get_history(prompt_id):
-    r = requests.get(f"{COMFY_URL}/history/{prompt_id}")
+    r = SESSION.get(HISTORY_URL + prompt_id, timeout=30)
     r.raise_for_status()
-    return r.json().get(prompt_id)
+    return orjson.loads(r.content).get(prompt_id)
 
 def get_image(filename, subfolder, folder_type):
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url = f"{COMFY_URL}/view?" + urllib.parse.urlencode(data)
-    r = requests.get(url)
+    """Fetch an output image from ComfyUI's /view endpoint straight into memory."""
+    params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+    r = SESSION.get(VIEW_URL, params=params, timeout=60)
     r.raise_for_status()
     return r.content
 
-def load_workflow(workflow_name):
-    path = f"/workspace/worker/workflows/{workflow_name}.json"
-    with open(path, 'r') as f:
-        return json.load(f)
+@functools.lru_cache(maxsize=1)
+def get_object_info():
+    """Node definitions from ComfyUI's /object_info, fetched once per worker."""
+    r = SESSION.get(OBJECT_INFO_URL, timeout=30)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+OUTPUT_NODE_TYPE = "SaveImage"  # the only node type whose images the handler returns
+MODE_MUTED = 2  # LiteGraph "never" mode
+MODE_BYPASS = 4
+
+class WorkflowTemplate(NamedTuple):
+    prompt: dict  # API format: node id (str) -> {"class_type": ..., "inputs": {...}}
+    output_nodes: tuple  # SaveImage node ids as strings, as keyed in history outputs
+    random_seeds: tuple  # (node_id, input) pairs the editor set to "randomize"
+    pruned_nodes: frozenset  # UI node ids (str) dropped because they cannot reach an output
+
+
+def topological_order(workflow):
+    """
+    Order node ids so every node comes after its inputs (Kahn's algorithm over
+    the UI-format "links" entries: [link_id, src, src_slot, dst, dst_slot, type]).
+    """
+    indegree = {node["id"]: 0 for node in workflow.get("nodes", [])}
+    consumers = defaultdict(list)
+    for link in workflow.get("links", []):
+        src, dst = link[1], link[3]
+        if src in indegree and dst in indegree:
+            consumers[src].append(dst)
+            indegree[dst] += 1
+
+    ready = deque(node_id for node_id, degree in indegree.items() if degree == 0)
+    order = []
+    while ready:
+        node_id = ready.popleft()
+        order.append(node_id)
+        for consumer in consumers[node_id]:
+            indegree[consumer] -= 1
+            if indegree[consumer] == 0:
+                ready.append(consumer)
+    return tuple(order)
+
+def flatten_reroutes(workflow):
+    """
+    Remove Reroute nodes (pure wire routing from the ComfyUI editor) from a
+    UI-format workflow, in place. Every link leaving a Reroute is re-pointed at
+    the real upstream output, following chained Reroutes, and links into
+    Reroutes are dropped. Consumers of a dangling Reroute are disconnected.
+    """
+    nodes = workflow.get("nodes", [])
+    reroutes = {node["id"]: node for node in nodes if node.get("type") == "Reroute"}
+    if not reroutes:
+        return workflow
+    links_by_id = {link[0]: link for link in workflow.get("links", [])}
+
+    def upstream_of(link):
+        seen = set()
+        while link is not None and link[1] in reroutes and link[1] not in seen:
+            seen.add(link[1])
+            inputs = reroutes[link[1]].get("inputs") or [{}]
+            link = links_by_id.get(inputs[0].get("link"))
+        return None if link is None or link[1] in reroutes else link
+
+    kept_nodes = [node for node in nodes if node["id"] not in reroutes]
+    kept_links = []
+    for link in workflow.get("links", []):
+        if link[3] in reroutes:
+            continue
+        if link[1] in reroutes:
+            upstream = upstream_of(link)
+            if upstream is None:
+                continue
+            link = [link[0], upstream[1], upstream[2], link[3], link[4], link[5]]
+        kept_links.append(link)
 
-def get_output_nodes(workflow):
-    save_nodes = []
-    for node_id, node_data in workflow.get("nodes", {}).items():
-        if node_data.get("class_type") == "SaveImage":
-            save_nodes.append(node_id)
-    return save_nodes
+    _set_nodes_and_links(workflow, kept_nodes, kept_links)
+    return workflow
+
+def prune_unused_nodes(workflow, topo_order):
+    """
+    Remove nodes that cannot reach a SaveImage node, in place, and return
+    their ids as strings. PreviewImage does not count as an output: the handler
+    never returns its images, so a branch ending there is dead weight. Muted
+    nodes (mode 2) are dropped too and do not keep their inputs alive; inputs
+    that were fed by a dropped node are disconnected. Walks the topological
+    order backwards so each node is visited once.
+    """
+    nodes_by_id = {node["id"]: node for node in workflow.get("nodes", [])}
+    consumers = defaultdict(list)
+    for link in workflow.get("links", []):
+        consumers[link[1]].append(link[3])
+
+    live = set()
+    for node_id in reversed(topo_order):
+        node = nodes_by_id[node_id]
+        if node.get("mode") == MODE_MUTED:
+            continue
+        if node.get("type") == OUTPUT_NODE_TYPE or any(c in live for c in consumers[node_id]):
+            live.add(node_id)
+
+    if len(live) == len(nodes_by_id):
+        return frozenset()
+    kept_nodes = [node for node in workflow["nodes"] if node["id"] in live]
+    kept_links = [link for link in workflow["links"] if link[1] in live and link[3] in live]
+    _set_nodes_and_links(workflow, kept_nodes, kept_links)
+    return frozenset(str(node_id) for node_id in nodes_by_id if node_id not in live)
+
+def _set_nodes_and_links(workflow, nodes, links):
+    # Rebuild each output's link list from the surviving links, and disconnect
+    # inputs whose link was removed so no node points at a missing link id
+    out_links = defaultdict(list)
+    for link in links:
+        out_links[(link[1], link[2])].append(link[0])
+    link_ids = {link[0] for link in links}
+    for node in nodes:
+        for node_input in node.get("inputs") or []:
+            if node_input.get("link") is not None and node_input["link"] not in link_ids:
+                node_input["link"] = None
+        for slot, output in enumerate(node.get("outputs") or []):
+            if output.get("links") is not None or (node["id"], slot) in out_links:
+                output["links"] = out_links.get((node["id"], slot), [])
+    workflow["nodes"] = nodes
+    workflow["links"] = links
+
+def is_api_format(workflow):
+    """True for an API-format export: a dict of node id -> {"class_type", "inputs"}."""
+    return (
+        isinstance(workflow, dict)
+        and bool(workflow)
+        and all(isinstance(node, dict) and "class_type" in node for node in workflow.values())
+    )
+
+# Inputs the editor gives a "control after generate" widget without the spec asking for one
+LEGACY_SEED_INPUTS = frozenset({"seed", "noise_seed"})
+
+def _is_widget_input(input_spec):
+    """Whether an /object_info input spec is shown as a widget (and so has a widgets_values slot)."""
+    input_type = input_spec[0]
+    options = input_spec[1] if len(input_spec) > 1 and isinstance(input_spec[1], dict) else {}
+    if options.get("forceInput"):
+        return False
+    return isinstance(input_type, list) or input_type in ("INT", "FLOAT", "STRING", "BOOLEAN", "COMBO")
+
+def _has_control_widget(name, input_spec):
+    """Whether the editor adds a "control after generate" widget (with its own widgets_values slot) after this input."""
+    if input_spec[0] != "INT":
+        return False
+    options = input_spec[1] if len(input_spec) > 1 and isinstance(input_spec[1], dict) else {}
+    return bool(options.get("control_after_generate")) or name in LEGACY_SEED_INPUTS
+
+def ui_to_api(workflow, object_info):
+    """
+    Convert a UI-format workflow (what the editor's "Save" writes) into the API
+    format /prompt executes, the way the editor does when queuing. Widget
+    values are matched to input names using ComfyUI's /object_info. Linked
+    inputs become [source id, output slot]. Bypassed nodes are wired through.
+
+    Returns (prompt, random_seeds), where random_seeds lists the (node id,
+    input) pairs whose seed the editor would re-roll on every queue.
+    """
+    links = {link[0]: link for link in workflow.get("links", [])}
+    nodes_by_id = {node["id"]: node for node in workflow["nodes"]}
+
+    def resolve(link):
+        # A bypassed node passes through its first input of the same type
+        seen = set()
+        while link is not None and nodes_by_id[link[1]].get("mode") == MODE_BYPASS:
+            if link[1] in seen:
+                return None
+            seen.add(link[1])
+            link = next(
+                (
+                    links[i["link"]]
+                    for i in nodes_by_id[link[1]].get("inputs") or []
+                    if i.get("type") == link[5] and i.get("link") in links
+                ),
+                None,
+            )
+        return link
+
+    prompt = {}
+    random_seeds = []
+    unknown_types = set()
+    for node in workflow["nodes"]:
+        if node.get("mode") in (MODE_MUTED, MODE_BYPASS):
+            continue
+        class_type = node["type"]
+        info = object_info.get(class_type)
+        if info is None:
+            unknown_types.add(class_type)
+            continue
+        node_id = str(node["id"])
+        linked = {}
+        for node_input in node.get("inputs") or []:
+            link = resolve(links.get(node_input.get("link")))
+            if link is not None:
+                linked[node_input["name"]] = [str(link[1]), link[2]]
+
+        widgets = node.get("widgets_values")
+        position = 0
+        inputs = {}
+        spec = info.get("input", {})
+        for name, input_spec in (*spec.get("required", {}).items(), *spec.get("optional", {}).items()):
+            if _is_widget_input(input_spec):
+                if isinstance(widgets, dict):
+                    if name in widgets:
+                        inputs[name] = widgets[name]
+                elif isinstance(widgets, list) and position < len(widgets):
+                    inputs[name] = widgets[position]
+                    position += 1
+                    if _has_control_widget(name, input_spec):
+                        if (
+                            position < len(widgets)
+                            and widgets[position] == "randomize"
+                            and name not in linked
+                        ):
+                            random_seeds.append((node_id, name))
+                        position += 1
+            if name in linked:
+                inputs[name] = linked[name]
+        prompt[node_id] = {
+            "class_type": class_type,
+            "inputs": inputs,
+            "_meta": {"title": node.get("title") or class_type},
+        }
+
+    if unknown_types:
+        raise ValueError(
+            "Workflow uses node types this ComfyUI does not have: " + ", ".join(sorted(unknown_types))
+        )
+    return prompt, tuple(random_seeds)
+
+# Keys whose string values repeat across nodes (slot types, node types, ...)
+_INTERNED_KEYS = frozenset({"type", "name", "cnr_id", "ver", "color", "bgcolor", "Node name for S&R"})
+
+def intern_strings(obj):
+    """
+    Replace the repeated string values of a parsed workflow with interned
+    copies so each distinct "IMAGE", "CONDITIONING", ... is stored once.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, str):
+                if key in _INTERNED_KEYS:
+                    obj[key] = sys.intern(value)
+            else:
+                intern_strings(value)
+    elif isinstance(obj, list):
+        for item in obj:
+            intern_strings(item)
+    return obj
+
+def _intern_link_types(workflow):
+    for link in workflow.get("links", []):
+        if len(link) > 5 and isinstance(link[5], str):
+            link[5] = sys.intern(link[5])
+
+def get_workflow_template(workflow_name):
+    """
+    Return the API-format template for a workflow file. API-format exports
+    are used as they are. UI-format files are cleaned up and converted, which
+    needs ComfyUI to be up for /object_info. The result is cached until the
+    file's mtime changes, so editing a workflow on the volume takes effect
+    without restarting the worker. The cached prompt must be treated as
+    read-only.
+    """
+    path = WORKFLOWS_DIR / f"{workflow_name}.json"
+    return _build_workflow_template(path, path.stat().st_mtime_ns)
+
+@functools.lru_cache(maxsize=8)
+def _build_workflow_template(path, mtime_ns):
+    workflow, pruned_nodes = _parse_workflow_file(path)
+    if is_api_format(workflow):
+        prompt, random_seeds = workflow, ()
+    else:
+        prompt, random_seeds = ui_to_api(workflow, get_object_info())
+    return WorkflowTemplate(prompt, tuple(get_output_nodes(prompt)), random_seeds, pruned_nodes)
+
+def _parse_workflow_file(path):
+    """
+    Parse a workflow file into (workflow, pruned node ids). UI-format graphs
+    also get their Reroute nodes and dead branches stripped.
+    """
+    workflow = intern_strings(orjson.loads(path.read_bytes()))
+    if is_api_format(workflow):
+        return workflow, frozenset()
+    if not isinstance(workflow, dict) or not isinstance(workflow.get("nodes"), list):
+        raise ValueError(
+            f"Workflow file '{path.name}' is neither an API-format nor a UI-format ComfyUI workflow"
+        )
+    workflow = flatten_reroutes(workflow)
+    _intern_link_types(workflow)
+    pruned_nodes = prune_unused_nodes(workflow, topological_order(workflow))
+    return workflow, pruned_nodes
+
+def patch_workflow(template, overrides):
+    """
+    Build the prompt for one job from a cached template without deep-copying it.
+    overrides maps (node_id, input_name) -> value. Only the touched nodes (and
+    their inputs) are copied; every other node is shared with the template by
+    reference, so the result must not be mutated further.
+    """
+    source = template.prompt
+    prompt = dict(source)
+    for (node_id, name), value in overrides.items():
+        node = prompt.get(node_id)
+        if node is None:
+            logger.warning("⚠️ Node %s not found in workflow, skipping override", node_id)
+            continue
+        if node is source[node_id]:
+            node = {**node, "inputs": dict(node["inputs"])}
+            prompt[node_id] = node
+        node["inputs"][name] = value
+    return prompt
+
+def find_bad_overrides(template, overrides):
+    """
+    Return a description of every (node_id, input_name) in overrides that the
+    template cannot take: a node that was pruned or is missing, or an input it
+    does not have as a plain value (absent, or wired to another node).
+    """
+    problems = []
+    for node_id, name in overrides:
+        node = template.prompt.get(node_id)
+        if node_id in template.pruned_nodes:
+            problems.append(f"node {node_id} was pruned (muted, or does not feed a SaveImage)")
+        elif node is None:
+            problems.append(f"node {node_id} not found")
+        elif name not in node["inputs"] or isinstance(node["inputs"][name], list):
+            problems.append(f"node {node_id} has no input {name!r}")
+    return problems
+
+def get_output_nodes(prompt):
+    return [node_id for node_id, node in prompt.items() if node.get("class_type") == OUTPUT_NODE_TYPE]
 
 # -----------------------------------------------------------------------------
 # NODE INJECTION (YOUR CUSTOM RULES)
 # -----------------------------------------------------------------------------
 
-def inject_inputs_fill(workflow, user_prompt, image_url):
+DEFAULT_POSITIVE_PROMPT = "A professional interior design photo"
+REDESIGN_REMOVAL_PROMPT = "remove all the furniture like sofas, tables, plants, lights, fireplace, paintings, curtains and carpet"
+
+def fill_overrides(user_prompt, image_url):
     """
     FILL workflow:
-    - Positive Prompt: Node 43[0]
-    - Image URL: Node 57[0]
+    - Positive Prompt: Node 43 (CLIPTextEncode) input "text"
+    - Image URL: Node 57 (LoadImageFromUrl) input "image"
     """
-    if "43" in workflow.get("nodes", {}):
-        workflow["nodes"]["43"]["inputs"]["text"] = user_prompt
-        print(f"✅ Injected user prompt into Node 43")
-    if "57" in workflow.get("nodes", {}):
-        workflow["nodes"]["57"]["inputs"]["image"] = image_url
-        print(f"✅ Injected image URL into Node 57")
+    return {
+        ("43", "text"): user_prompt,
+        ("57", "image"): image_url,
+    }
 
-def inject_inputs_redesign(workflow, user_prompt):
+def redesign_overrides(user_prompt, image_url=None):
     """
     REDESIGN workflow:
-    - User Positive Prompt: Node 63[0]
-    - Fixed furniture-removal prompt: Node 15[0]
+    - User Positive Prompt: Node 63 (ttN text) input "text"
+    - Fixed furniture-removal prompt: Node 15 (CLIPTextEncode) input "text"
     """
-    if "63" in workflow.get("nodes", {}):
-        workflow["nodes"]["63"]["inputs"]["text"] = user_prompt
-        print(f"✅ Injected user prompt into Node 63")
+    return {
+        ("63", "text"): user_prompt,
+        ("15", "text"): REDESIGN_REMOVAL_PROMPT,
+    }
 
-    if "15" in workflow.get("nodes", {}):
-        workflow["nodes"]["15"]["inputs"]["text"] = "remove all the furniture like sofas, tables, plants, lights, fireplace, paintings, curtains and carpet"
-        print(f"✅ Hard-coded removal prompt into Node 15")
+MAX_UPLOAD_WORKERS = 8
+# Same range the ComfyUI editor uses when it randomizes a seed
+MAX_SEED = 1125899906842624
+
+def process_output_image(img_data):
+    """
+    Fetch one output image and upload it, falling back to inline base64.
+    Returns the output dict, or an error message string if the image could
+    not be fetched, so one bad image does not fail the whole job.
+    """
+    try:
+        img_bytes = get_image(img_data["filename"], img_data["subfolder"], img_data["type"])
+    except requests.RequestException as e:
+        logger.error("Failed to fetch %s: %s", img_data["filename"], e)
+        return f"Failed to fetch {img_data['filename']}: {e}"
+    # Upload to Cloudflare straight from memory, no temp file
+    uploaded_url = upload_to_cloudflare_images(img_bytes, img_data["filename"])
+    if uploaded_url:
+        return {"url": uploaded_url}
+    return {"base64": pybase64.b64encode_as_string(img_bytes)}
+
+# workflow type (job input) -> (workflow file name, overrides builder)
+WORKFLOWS = {
+    "fill": ("fill", fill_overrides),
+    "redesign": ("Redesign", redesign_overrides),
+}
+
+def preload_workflow_templates():
+    """
+    Build every known workflow's template before the first job so it is not
+    on its critical path, and check that its injection targets exist. Needs
+    ComfyUI up, since UI-format files are converted using /object_info.
+    """
+    for workflow_file, build_overrides in WORKFLOWS.values():
+        try:
+            template = get_workflow_template(workflow_file)
+        except FileNotFoundError:
+            logger.warning("⚠️ Workflow file '%s.json' not found in %s", workflow_file, WORKFLOWS_DIR)
+            continue
+        except (ValueError, requests.RequestException) as e:
+            logger.warning("⚠️ Workflow '%s': %s", workflow_file, e)
+            continue
+        for problem in find_bad_overrides(template, build_overrides("", "")):
+            logger.warning("⚠️ Workflow '%s': %s", workflow_file, problem)
+
+def warm_up_comfy():
+    """
+    Wait for ComfyUI, open the worker's websocket and build the workflow
+    templates in the background while the worker starts, so the first job
+    finds all of them ready.
+    """
+    try:
+        if check_comfy_ready():
+            get_ws()
+            logger.info("ComfyUI websocket connected.")
+            preload_workflow_templates()
+        else:
+            logger.warning("⚠️ ComfyUI not reachable during warm-up, connecting on first job instead")
+    except Exception as e:
+        logger.warning("⚠️ ComfyUI warm-up failed, connecting on first job instead: %s", e)
 
 # -----------------------------------------------------------------------------
 # MAIN HANDLER
 # -----------------------------------------------------------------------------
 
+def validate_job_input(job_input):
+    """
+    Check the job input before any I/O. Returns (workflow_type, None) or
+    (None, error message).
+    """
+    workflow_type = str(job_input.get("workflow") or "fill").strip().lower()
+    if workflow_type not in WORKFLOWS:
+        return None, f"Unknown workflow '{workflow_type}'. Expected one of: {', '.join(WORKFLOWS)}"
+    if workflow_type == "fill" and not job_input.get("image_url"):
+        return None, "Missing 'image_url' for the fill workflow"
+    return workflow_type, None
+
 def handler(job):
     job_input = job.get("input", {})
-    print(f"worker-comfyui - Received job input: {json.dumps(job_input)}")
+    logger.info("Received job input: %s", orjson.dumps(job_input).decode())
 
-    # Select workflow type
-    workflow_type = job_input.get("workflow", "fill").strip().lower()
-    if workflow_type == "redesign":
-        workflow_file = "Redesign"
-    else:
-        workflow_file = "fill"
+    # Reject malformed jobs before touching ComfyUI or the network
+    workflow_type, error = validate_job_input(job_input)
+    if error:
+        return {"error": error}
+    workflow_file, build_overrides = WORKFLOWS[workflow_type]
 
-    print(f"worker-comfyui - Selected workflow: {workflow_file}")
+    logger.info("Selected workflow: %s", workflow_file)
 
-    # Load workflow file
+    # Wait for ComfyUI server (UI-format templates are converted with its /object_info)
+    if not check_comfy_ready():
+        return {"error": "ComfyUI server did not become ready in time."}
+
+    # Load workflow template (built once per worker)
     try:
-        workflow = load_workflow(workflow_file)
+        template = get_workflow_template(workflow_file)
     except FileNotFoundError:
         return {"error": f"Workflow file '{workflow_file}.json' not found on server."}
+    except (ValueError, requests.RequestException) as e:
+        return {"error": f"Could not load workflow '{workflow_file}': {e}"}
 
     # Extract user inputs
-    user_prompt = job_input.get("positive_prompt", "A professional interior design photo")
+    user_prompt = job_input.get("positive_prompt", DEFAULT_POSITIVE_PROMPT)
     image_url = job_input.get("image_url", "")
 
-    # Apply user inputs
-    if workflow_file.lower() == "fill":
-        inject_inputs_fill(workflow, user_prompt, image_url)
-    else:
-        inject_inputs_redesign(workflow, user_prompt)
-
-    # Wait for ComfyUI server
-    if not check_comfy_ready():
-        return {"error": "ComfyUI server did not become ready in time."}
+    # Apply user inputs on top of the shared template; seeds the editor had on
+    # "randomize" get a fresh value so repeated jobs are not served from cache
+    overrides = build_overrides(user_prompt, image_url)
+    overrides.update({key: random.randrange(MAX_SEED) for key in template.random_seeds})
+    workflow = patch_workflow(template, overrides)
+    logger.info("✅ Injected %d inputs into workflow", len(overrides))
 
-    # WebSocket setup
-    client_id = str(uuid.uuid4())
-    ws = None
     output_images = []
     errors = []
 
     try:
-        ws = connect_ws(client_id)
-        prompt_id = queue_prompt(workflow, client_id)
-        print(f"worker-comfyui - Queued prompt ID: {prompt_id}")
-
-        while True:
-            message = ws.recv()
-            if isinstance(message, str):
-                msg = json.loads(message)
-                if msg.get("type") == "executing" and msg["data"].get("node") is None:
-                    print("worker-comfyui - Execution complete.")
-                    break
-            else:
-                continue
-
-        history = get_history(prompt_id)
-        if not history:
-            return {"error": f"No history found for prompt_id {prompt_id}"}
+        # Connect (or reuse the worker's websocket) before queuing so no
+        # progress message for this prompt can be missed
+        get_ws()
+        prompt_id = queue_prompt(workflow, CLIENT_ID)
+        logger.info("Queued prompt ID: %s", prompt_id)
 
-        # Find outputs
-        output_nodes = get_output_nodes(workflow)
+        try:
+            outputs = wait_for_prompt(prompt_id)
+        except RuntimeError:
+            # ComfyUI reported an execution error: the prompt is already over
+            raise
+        except Exception:
+            cancel_prompt(prompt_id)
+            raise
+
+        # The websocket usually reported every output already; only ask
+        # /history when something is missing
+        output_nodes = template.output_nodes
+        if outputs is None or not all(node_id in outputs for node_id in output_nodes):
+            history = get_history(prompt_id)
+            if not history:
+                return {"error": f"No history found for prompt_id {prompt_id}"}
+            # Reached after a reconnect the error message may have been missed
+            for message_type, data in history.get("status", {}).get("messages", []):
+                if message_type == "execution_error":
+                    raise RuntimeError(format_execution_error(data))
+            outputs = history.get("outputs", {})
+
+        images = []
         for node_id in output_nodes:
-            node_output = history.get("outputs", {}).get(node_id, {})
+            node_output = outputs.get(node_id, {})
             if "images" in node_output:
-                for img_data in node_output["images"]:
-                    img_bytes = get_image(img_data["filename"], img_data["subfolder"], img_data["type"])
-                    # Upload to Cloudflare
-                    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
-                        tmp_file.write(img_bytes)
-                        temp_file_path = tmp_file.name
-                    uploaded_url = upload_to_cloudflare_images(temp_file_path)
-                    os.remove(temp_file_path)
-
-                    if uploaded_url:
-                        output_images.append({"url": uploaded_url})
-                    else:
-                        base64_data = base64.b64encode(img_bytes).decode("utf-8")
-                        output_images.append({"base64": base64_data})
+                images.extend(node_output["images"])
+
+        # Fetch + upload the images concurrently; results keep their order
+        if images:
+            with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(images))) as executor:
+                results = list(executor.map(process_output_image, images))
+            output_images = [r for r in results if isinstance(r, dict)]
+            errors.extend(r for r in results if isinstance(r, str))
 
     except Exception as e:
-        print(f"worker-comfyui - Error: {e}")
-        print(traceback.format_exc())
+        logger.exception("Error: %s", e)
         errors.append(str(e))
-    finally:
-        if ws and ws.connected:
-            ws.close()
 
     if not output_images and errors:
         return {"error": "Job failed", "details": errors}
 
-    print(f"worker-comfyui - Completed job with {len(output_images)} images.")
+    logger.info("Completed job with %d images.", len(output_images))
     return {"images": output_images, "errors": errors}
 
 # -----------------------------------------------------------------------------
 # ENTRY POINT
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
-    print("worker-comfyui - Starting handler...")
+    # force: importing runpod already put a handler on the root logger
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        format="%(name)s - %(message)s",
+        stream=sys.stdout,
+        force=True,
+    )
+    logger.info("Starting handler...")
+    threading.Thread(target=warm_up_comfy, name="comfy-warm-up", daemon=True).start()
     runpod.serverless.start({"handler": handler})
@@ -4,6 +4,7 @@ import sys
 import os
 import json
 import base64
+import tempfile
 
 # Make sure that "src" is known and can be used to import handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
@@ -11,6 +12,52 @@ from src import handler
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
+WORKFLOWS_DIR = os.path.join(os.path.dirname(__file__), "..", "workflows")
+
+
+def load_workflow_file(name):
+    with open(os.path.join(WORKFLOWS_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+# /object_info entries (input specs only) for the node types in workflows/fill.json
+FILL_OBJECT_INFO = {
+    "DualCLIPLoader": {"input": {
+        "required": {"clip_name1": [["clip_l.safetensors"]], "clip_name2": [["t5xxl_fp8_e4m3fn_scaled.safetensors"]],
+                     "type": [["flux"]]},
+        "optional": {"device": [["default", "cpu"]]},
+    }},
+    "VAEEncode": {"input": {"required": {"pixels": ["IMAGE"], "vae": ["VAE"]}}},
+    "PreviewImage": {"input": {"required": {"images": ["IMAGE"]}}},
+    "ConditioningZeroOut": {"input": {"required": {"conditioning": ["CONDITIONING"]}}},
+    "ReferenceLatent": {"input": {"required": {"conditioning": ["CONDITIONING"]}, "optional": {"latent": ["LATENT"]}}},
+    "FluxKontextImageScale": {"input": {"required": {"image": ["IMAGE"]}}},
+    "SaveImage": {"input": {"required": {"images": ["IMAGE"], "filename_prefix": ["STRING", {"default": "ComfyUI"}]}}},
+    "VAEDecode": {"input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}}},
+    "UNETLoader": {"input": {"required": {"unet_name": [["FLUX.1-Kontext-dev-1"]], "weight_dtype": [["default"]]}}},
+    "VAELoader": {"input": {"required": {"vae_name": [["ae.sft"]]}}},
+    "CLIPTextEncode": {"input": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}}},
+    "FluxGuidance": {"input": {"required": {"conditioning": ["CONDITIONING"], "guidance": ["FLOAT", {}]}}},
+    "KSampler": {"input": {"required": {
+        "model": ["MODEL"], "seed": ["INT", {"control_after_generate": True}], "steps": ["INT", {}],
+        "cfg": ["FLOAT", {}], "sampler_name": [["euler"]], "scheduler": [["normal"]],
+        "positive": ["CONDITIONING"], "negative": ["CONDITIONING"], "latent_image": ["LATENT"],
+        "denoise": ["FLOAT", {}],
+    }}},
+    "LoadImageFromUrl": {"input": {"required": {
+        "image": ["STRING", {"multiline": True}], "keep_alpha_channel": ["BOOLEAN", {}],
+        "output_mode": ["BOOLEAN", {}],
+    }}},
+}
+
+
+def load_fill_template():
+    workflow = handler.flatten_reroutes(load_workflow_file("fill"))
+    pruned_nodes = handler.prune_unused_nodes(workflow, handler.topological_order(workflow))
+    prompt, random_seeds = handler.ui_to_api(workflow, FILL_OBJECT_INFO)
+    return handler.WorkflowTemplate(
+        prompt, tuple(handler.get_output_nodes(prompt)), random_seeds, pruned_nodes
+    )
 
 
 class TestRunpodWorkerComfy(unittest.TestCase):
@@ -236,3 +283,345 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+    def test_format_prompt_error_lists_node_errors(self):
+        mock_response = Mock()
+        mock_response.content = json.dumps(
+            {
+                "error": {"message": "Prompt outputs failed validation"},
+                "node_errors": {
+                    "43": {
+                        "class_type": "CLIPTextEncode",
+                        "errors": [{"message": "Required input is missing", "details": "clip"}],
+                    }
+                },
+            }
+        ).encode()
+
+        message = handler.format_prompt_error(mock_response)
+
+        self.assertIn("Prompt outputs failed validation", message)
+        self.assertIn("Node 43 (CLIPTextEncode): Required input is missing clip", message)
+
+    def test_format_prompt_error_falls_back_to_raw_body(self):
+        mock_response = Mock()
+        mock_response.content = b"<html>Bad Request</html>"
+        mock_response.text = "<html>Bad Request</html>"
+
+        message = handler.format_prompt_error(mock_response)
+
+        self.assertEqual(message, "ComfyUI rejected the workflow: <html>Bad Request</html>")
+
+    def test_topological_order_puts_inputs_first(self):
+        workflow = load_workflow_file("Redesign")
+
+        order = handler.topological_order(workflow)
+
+        position = {node_id: i for i, node_id in enumerate(order)}
+        self.assertEqual(len(order), len(workflow["nodes"]))
+        for link in workflow["links"]:
+            self.assertLess(position[link[1]], position[link[3]])
+
+    def test_patch_workflow_copies_only_touched_nodes(self):
+        template = load_fill_template()
+        original_text = template.prompt["43"]["inputs"]["text"]
+
+        patched = handler.patch_workflow(
+            template, handler.fill_overrides("a cozy room", "https://example.com/room.png")
+        )
+
+        self.assertEqual(patched["43"]["inputs"]["text"], "a cozy room")
+        self.assertEqual(patched["57"]["inputs"]["image"], "https://example.com/room.png")
+        # The cached template is untouched and unchanged nodes are shared
+        self.assertEqual(template.prompt["43"]["inputs"]["text"], original_text)
+        self.assertEqual(template.prompt["57"]["inputs"]["image"], "")
+        self.assertIs(patched["6"], template.prompt["6"])
+
+    def test_ui_to_api_converts_shipped_fill_workflow(self):
+        template = load_fill_template()
+
+        self.assertEqual(template.output_nodes, ("42",))
+        self.assertEqual(template.random_seeds, (("6", "seed"),))
+        ksampler = template.prompt["6"]
+        self.assertEqual(ksampler["class_type"], "KSampler")
+        self.assertEqual(ksampler["inputs"]["model"], ["46", 0])
+        self.assertEqual(
+            {k: v for k, v in ksampler["inputs"].items() if not isinstance(v, list)},
+            {"seed": 350530340099539, "steps": 20, "cfg": 1, "sampler_name": "euler",
+             "scheduler": "normal", "denoise": 1},
+        )
+        self.assertEqual(
+            template.prompt["57"]["inputs"],
+            {"image": "", "keep_alpha_channel": False, "output_mode": False},
+        )
+        # Every link points at a node that is part of the prompt
+        for node in template.prompt.values():
+            for value in node["inputs"].values():
+                if isinstance(value, list):
+                    self.assertIn(value[0], template.prompt)
+
+    def test_ui_to_api_bypasses_nodes_and_rejects_unknown_types(self):
+        object_info = {
+            "LoadImage": {"input": {"required": {"image": [["a.png"], {"image_upload": True}]}}},
+            "ImageInvert": {"input": {"required": {"image": ["IMAGE"]}}},
+            "SaveImage": FILL_OBJECT_INFO["SaveImage"],
+        }
+        workflow = {
+            "nodes": [
+                {"id": 1, "type": "LoadImage", "widgets_values": ["in.png", "image"]},
+                {"id": 2, "type": "ImageInvert", "mode": 4, "inputs": [{"name": "image", "type": "IMAGE", "link": 1}]},
+                {"id": 3, "type": "SaveImage", "inputs": [{"name": "images", "type": "IMAGE", "link": 2}],
+                 "widgets_values": ["out"]},
+            ],
+            "links": [[1, 1, 0, 2, 0, "IMAGE"], [2, 2, 0, 3, 0, "IMAGE"]],
+        }
+
+        prompt, random_seeds = handler.ui_to_api(workflow, object_info)
+
+        self.assertEqual(set(prompt), {"1", "3"})
+        self.assertEqual(prompt["1"]["inputs"], {"image": "in.png"})
+        self.assertEqual(prompt["3"]["inputs"], {"images": ["1", 0], "filename_prefix": "out"})
+        self.assertEqual(random_seeds, ())
+
+        del object_info["LoadImage"]
+        with self.assertRaisesRegex(ValueError, "node types this ComfyUI does not have: LoadImage"):
+            handler.ui_to_api(workflow, object_info)
+
+    def test_ui_to_api_reads_control_widget_from_spec_not_value(self):
+        object_info = {"Custom": {"input": {"required": {
+            "steps": ["INT", {}], "mode": [["fixed", "scaled"]], "label": ["STRING", {}],
+            "noise_seed": ["INT", {}], "seed": ["INT", {"control_after_generate": True}],
+        }}}}
+        workflow = {
+            "nodes": [{"id": 1, "type": "Custom",
+                       "widgets_values": [20, "fixed", "hello", 7, "randomize", 8, "fixed"]}],
+            "links": [],
+        }
+
+        prompt, random_seeds = handler.ui_to_api(workflow, object_info)
+
+        self.assertEqual(
+            prompt["1"]["inputs"], {"steps": 20, "mode": "fixed", "label": "hello", "noise_seed": 7, "seed": 8}
+        )
+        self.assertEqual(random_seeds, (("1", "noise_seed"),))
+
+    def test_flatten_reroutes_rewires_links_to_real_sources(self):
+        workflow = load_workflow_file("fill")
+
+        handler.flatten_reroutes(workflow)
+
+        nodes = {node["id"]: node for node in workflow["nodes"]}
+        links = {link[0]: link for link in workflow["links"]}
+        self.assertNotIn("Reroute", {node["type"] for node in nodes.values()})
+        # KSampler's model input now comes straight from the UNETLoader
+        model_input = next(i for i in nodes[6]["inputs"] if i["name"] == "model")
+        self.assertEqual(links[model_input["link"]][1], 46)
+        for link in workflow["links"]:
+            self.assertIn(link[1], nodes)
+            self.assertIn(link[3], nodes)
+
+    def test_prune_unused_nodes_drops_dead_and_muted_branches(self):
+        workflow = {
+            "nodes": [
+                {"id": 1, "type": "LoadImage", "outputs": [{"links": [1, 2, 4]}]},
+                {"id": 2, "type": "SaveImage", "inputs": [{"link": 1}]},
+                {"id": 3, "type": "VAEEncode", "inputs": [{"link": 2}], "outputs": [{"links": None}]},
+                {"id": 4, "type": "ImageInvert", "mode": 2, "outputs": [{"links": [3]}]},
+                {"id": 5, "type": "SaveImage", "inputs": [{"link": 3}]},
+                {"id": 6, "type": "PreviewImage", "inputs": [{"link": 4}]},
+            ],
+            "links": [
+                [1, 1, 0, 2, 0, "IMAGE"], [2, 1, 0, 3, 0, "IMAGE"],
+                [3, 4, 0, 5, 0, "IMAGE"], [4, 1, 0, 6, 0, "IMAGE"],
+            ],
+        }
+
+        pruned = handler.prune_unused_nodes(workflow, handler.topological_order(workflow))
+
+        self.assertEqual(pruned, {"3", "4", "6"})
+        self.assertEqual([node["id"] for node in workflow["nodes"]], [1, 2, 5])
+        self.assertEqual(workflow["links"], [[1, 1, 0, 2, 0, "IMAGE"]])
+        self.assertEqual(workflow["nodes"][0]["outputs"][0]["links"], [1])
+        # SaveImage 5 was only fed by the muted node: its input is disconnected
+        self.assertIsNone(workflow["nodes"][2]["inputs"][0]["link"])
+
+    @patch.dict(os.environ, {"CF_IMAGES_ACCOUNT_ID": "acc", "CF_IMAGES_API_TOKEN": "token"})
+    def test_upload_to_cloudflare_images_from_memory(self):
+        handler.get_config.cache_clear()
+        self.addCleanup(handler.get_config.cache_clear)
+        mock_response = Mock()
+        mock_response.content = json.dumps(
+            {"success": True, "result": {"variants": ["https://imagedelivery.net/x/public"]}}
+        ).encode()
+
+        with patch.object(handler.SESSION, "post", return_value=mock_response) as mock_post:
+            url = handler.upload_to_cloudflare_images(b"png bytes", "ComfyUI_00001_.png")
+
+        self.assertEqual(url, "https://imagedelivery.net/x/public")
+        args, kwargs = mock_post.call_args
+        self.assertEqual(args[0], "https://api.cloudflare.com/client/v4/accounts/acc/images/v1")
+        self.assertEqual(kwargs["headers"]["Authorization"], "Bearer token")
+        self.assertIn(b"png bytes", kwargs["data"].to_string())
+
+    def test_wait_for_prompt_collects_outputs_for_its_prompt(self):
+        image = {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+        mock_ws = Mock()
+        text = lambda msg: (handler.websocket.ABNF.OPCODE_TEXT, json.dumps(msg).encode())
+        mock_ws.recv_data.side_effect = [
+            text({"type": "executing", "data": {"node": None, "prompt_id": "old"}}),
+            text({"type": "progress", "data": {"value": 1, "max": 4}}),
+            text({"type": "executed", "data": {"node": "9", "output": {"images": [image]}, "prompt_id": "p1"}}),
+            (handler.websocket.ABNF.OPCODE_BINARY, b"\x00\x00\x00\x01preview"),
+            text({"type": "executing", "data": {"node": None, "prompt_id": "p1"}}),
+        ]
+
+        with patch.object(handler, "get_ws", return_value=mock_ws):
+            outputs = handler.wait_for_prompt("p1")
+
+        self.assertEqual(outputs, {"9": {"images": [image]}})
+
+    def test_validate_job_input(self):
+        self.assertEqual(
+            handler.validate_job_input({"image_url": "https://x/y.png"}), ("fill", None)
+        )
+        self.assertEqual(handler.validate_job_input({"workflow": " Redesign "}), ("redesign", None))
+
+        workflow_type, error = handler.validate_job_input({"workflow": "upscale"})
+        self.assertIsNone(workflow_type)
+        self.assertIn("Unknown workflow 'upscale'", error)
+
+        workflow_type, error = handler.validate_job_input({"workflow": "fill"})
+        self.assertIsNone(workflow_type)
+        self.assertIn("image_url", error)
+
+    def test_find_bad_overrides(self):
+        template = load_fill_template()
+        self.assertEqual(handler.find_bad_overrides(template, handler.fill_overrides("", "")), [])
+        self.assertEqual(
+            handler.find_bad_overrides(template, {("43", "clip"): "", ("43", "txt"): "", ("999", "text"): ""}),
+            ["node 43 has no input 'clip'", "node 43 has no input 'txt'", "node 999 not found"],
+        )
+        # PreviewImage 8 is not returned by the handler, so it is pruned
+        self.assertEqual(
+            handler.find_bad_overrides(template, {("8", "images"): ""}),
+            ["node 8 was pruned (muted, or does not feed a SaveImage)"],
+        )
+
+    def test_process_output_image_returns_error_string_on_fetch_failure(self):
+        image = {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+        with patch.object(handler, "get_image", side_effect=handler.requests.ConnectionError("refused")):
+            result = handler.process_output_image(image)
+
+        self.assertEqual(result, "Failed to fetch ComfyUI_00001_.png: refused")
+
+    def test_get_workflow_template_reloads_when_file_changes(self):
+        with tempfile.TemporaryDirectory() as workflows_dir:
+            path = os.path.join(workflows_dir, "fill.json")
+            workflow = load_workflow_file("fill")
+            with open(path, "w") as f:
+                json.dump(workflow, f)
+
+            with patch.object(handler, "WORKFLOWS_DIR", handler.pathlib.Path(workflows_dir)), \
+                    patch.object(handler, "get_object_info", return_value=FILL_OBJECT_INFO):
+                first = handler.get_workflow_template("fill")
+                self.assertIs(handler.get_workflow_template("fill"), first)
+
+                workflow["nodes"] = [n for n in workflow["nodes"] if n["id"] != 42]
+                with open(path, "w") as f:
+                    json.dump(workflow, f)
+                os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+
+                second = handler.get_workflow_template("fill")
+
+        self.assertIsNot(second, first)
+        self.assertEqual(first.output_nodes, ("42",))
+        self.assertEqual(second.output_nodes, ())
+
+    def test_get_workflow_template_uses_api_format_as_is(self):
+        prompt = {
+            "3": {"class_type": "KSampler", "inputs": {"seed": 1}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0], "filename_prefix": "x"}},
+        }
+        with tempfile.TemporaryDirectory() as workflows_dir:
+            with open(os.path.join(workflows_dir, "api.json"), "w") as f:
+                json.dump(prompt, f)
+
+            with patch.object(handler, "WORKFLOWS_DIR", handler.pathlib.Path(workflows_dir)), \
+                    patch.object(handler, "get_object_info") as mock_object_info:
+                template = handler.get_workflow_template("api")
+
+        self.assertEqual(template.prompt, prompt)
+        self.assertEqual(template.output_nodes, ("9",))
+        mock_object_info.assert_not_called()
+
+    def test_wait_for_prompt_gives_up_after_second_timeout(self):
+        mock_ws = Mock()
+        mock_ws.recv_data.side_effect = handler.websocket.WebSocketTimeoutException("timed out")
+
+        with patch.object(handler, "get_ws", return_value=mock_ws), \
+                patch.object(handler, "reset_ws") as mock_reset, \
+                patch.object(handler, "get_history", return_value=None) as mock_history:
+            with self.assertRaises(handler.websocket.WebSocketTimeoutException):
+                handler.wait_for_prompt("p1")
+
+        self.assertEqual(mock_reset.call_count, 2)
+        mock_history.assert_called_once_with("p1")
+
+    def test_check_comfy_ready_reverifies_open_websocket(self):
+        self.addCleanup(setattr, handler, "_ws", None)
+        handler._ws = Mock(connected=True)
+        with patch.object(handler.PROBE_SESSION, "get", return_value=Mock(status_code=200)) as mock_get:
+            self.assertTrue(handler.check_comfy_ready())
+        mock_get.assert_called_once_with(handler.QUEUE_URL, timeout=0.5)
+        self.assertIsNotNone(handler._ws)
+
+        # ComfyUI died but the websocket still looks connected
+        stale_ws = Mock(connected=True)
+        handler._ws = stale_ws
+        with patch.object(handler.PROBE_SESSION, "get", side_effect=handler.requests.ConnectionError("refused")), \
+                patch.object(handler.time, "sleep"):
+            self.assertFalse(handler.check_comfy_ready(timeout=0))
+        stale_ws.close.assert_called_once()
+        self.assertIsNone(handler._ws)
+
+    def test_check_comfy_ready_retries_timed_out_probe_without_sleeping(self):
+        responses = [handler.requests.ReadTimeout("slow"), Mock(status_code=200)]
+        with patch.object(handler.PROBE_SESSION, "get", side_effect=responses) as mock_get, \
+                patch.object(handler.time, "sleep") as mock_sleep:
+            self.assertTrue(handler.check_comfy_ready())
+        self.assertEqual(mock_get.call_count, 2)
+        mock_sleep.assert_not_called()
+
+    def test_cancel_prompt_deletes_and_interrupts(self):
+        with patch.object(handler.SESSION, "post") as mock_post:
+            handler.cancel_prompt("p1")
+
+        urls = [call.args[0] for call in mock_post.call_args_list]
+        self.assertEqual(urls, [handler.QUEUE_URL, handler.INTERRUPT_URL])
+        self.assertEqual(json.loads(mock_post.call_args_list[0].kwargs["data"]), {"delete": ["p1"]})
+
+    @patch.dict(os.environ, {"COMFY_WS_TIMEOUT": "five minutes"})
+    def test_invalid_ws_timeout_falls_back_to_default(self):
+        handler.get_config.cache_clear()
+        self.addCleanup(handler.get_config.cache_clear)
+        self.assertEqual(handler.get_config().ws_recv_timeout, 300.0)
+
+    def test_wait_for_prompt_raises_execution_error(self):
+        error = {
+            "prompt_id": "p1", "node_id": "57", "node_type": "LoadImageFromUrl",
+            "exception_type": "HTTPError", "exception_message": "404 Not Found\n",
+        }
+        mock_ws = Mock()
+        mock_ws.recv_data.side_effect = [
+            (handler.websocket.ABNF.OPCODE_TEXT, json.dumps({"type": "execution_error", "data": error}).encode()),
+            (handler.websocket.ABNF.OPCODE_TEXT, json.dumps(
+                {"type": "executing", "data": {"node": None, "prompt_id": "p1"}}).encode()),
+        ]
+
+        with patch.object(handler, "get_ws", return_value=mock_ws):
+            with self.assertRaises(RuntimeError) as ctx:
+                handler.wait_for_prompt("p1")
+
+        self.assertEqual(
+            str(ctx.exception), "ComfyUI failed at node 57 (LoadImageFromUrl): HTTPError: 404 Not Found"
+        )